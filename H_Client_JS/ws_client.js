@@ -11,6 +11,7 @@ class WSClient {
         this.onopen = null;
         this.onclose = null;
         this.onerror = null;
+        this.decoder = new TextDecoder('utf-8');
     }
 
     connect(url) {
@@ -22,6 +23,9 @@ class WSClient {
                 reject(e);
                 return;
             }
+            // サーバーはブロードキャストをバイナリフレーム（UTF-8 JSON）で送るため
+            // ArrayBuffer で受け取り、テキストに復号してからパースする
+            this.ws.binaryType = 'arraybuffer';
             this.ws.addEventListener('open', (ev) => {
                 opened = true;
                 if (this.onopen) this.onopen(ev);
@@ -29,8 +33,15 @@ class WSClient {
             });
             this.ws.addEventListener('message', (ev) => {
                 try {
-                    const j = JSON.parse(ev.data);
-                    if (this.onmessage) this.onmessage(j);
+                    const text = typeof ev.data === 'string' ? ev.data : this.decoder.decode(ev.data);
+                    const j = JSON.parse(text);
+                    if (!this.onmessage) return;
+                    // サーバーは短時間に発生したイベントを batch にまとめて送ることがある
+                    if (j && j.type === 'batch' && Array.isArray(j.events)) {
+                        j.events.forEach((e) => this.onmessage(e));
+                    } else {
+                        this.onmessage(j);
+                    }
                 } catch (e) {
                     console.warn('ws parse error', e);
                 }
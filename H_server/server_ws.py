@@ -12,21 +12,29 @@ WebSocket ベースのプロトタイプサーバー
    - leave: {"type":"leave","role":"player"|"spectator","id":"..."}
  - サーバー -> クライアント（ブロードキャスト）
    - events は既存と同様の形式（"player_joined", "player_action", ...）を送る
+   - 短時間に複数のイベントが発生した場合は {"type":"batch","events":[...]} にまとめて送る
 
 簡易実装であり、永続化や認証、スケーリングは行っていません。将来的には Redis
 などを用いた pub/sub に置き換えてスケールさせる想定です。
 """
 
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import Response
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.websockets import WebSocketState
 import asyncio
-import secrets
+import heapq
+import itertools
+from collections import deque
 import string
 import datetime
-from typing import Dict, Any, Set, Optional
+import functools
+import time
+from typing import Dict, Any, Optional, Tuple, Union
 import random
+import uuid
 import logging
+import orjson
 from fastapi import Query
 
 app = FastAPI()
@@ -47,23 +55,60 @@ if not logger.handlers:
 
 
 # rooms: room_id -> dict
-# each room: { "room_id": str, "players": [ {player_id,name,slot,...} ],
-#              "spectators": [...], "events": [...], "next_event_id": int,
-#              "connections": set(WebSocket), "lock": asyncio.Lock() }
+# each room: { "room_id": str, "players_by_id": {player_id: {player_id,name,slot,...}},
+#              "spectators_by_id": {spectator_id: spectator}, "free_slots": heap[int],
+#              "owners": bytearray(10), "owner_names": [str], "owner_codes": {str: int},
+#              "events": deque([...]), "next_event_id": int,
+#              "snapshot_bytes": bytes|None, "http_room_bytes": bytes|None,
+#              "connections": {WebSocket: asyncio.Queue(bytes)} }
+#
+# ルーム状態はシングルスレッドのイベントループ上でのみ変更します。ハンドラは
+# 状態の確認から変更までの間に await を挟まないため、その区間はロックなしでも
+# 他のタスクに割り込まれません。そのためルーム単位のロックは持ちません。
 rooms: Dict[str, Dict[str, Any]] = {}
 
 MAX_EVENTS_PER_ROOM = 1000
 
+# 接続ごとの送信キューの上限。これを超えて未送信が溜まった遅いクライアントは切断する
+CLIENT_SEND_QUEUE_MAX = 64
+# 接続終了時、送信キューの残りを送り切るのを待つ最大時間（秒）
+CLIENT_FLUSH_TIMEOUT = 1.0
+
+# ハートビート: uvicorn (websockets-sansio 実装) が WS_PING_INTERVAL 秒ごとにプロトコルレベルの
+# ping を送り、WS_PING_TIMEOUT 秒以内に pong が返らない接続を閉じる（値は uvicorn の
+# 既定値と同じ。起動方法によらず同じ設定になるよう明示している）。閉じた接続は
+# websocket_endpoint の finally でルームから外され、player_left / spectator_left が配信される
+WS_PING_INTERVAL = 20.0
+WS_PING_TIMEOUT = 20.0
+
+# 札 ID 0..99。ルーム作成やゲーム開始のたびにリストを作り直さないよう共有する
+_DECK: Tuple[int, ...] = tuple(range(100))
+
+# owners テーブルで「未所有」を表す値。owners[i] はそれ以外なら owner_names の添字
+_UNOWNED = 0xFF
+_UNOWNED_BYTE = bytes((_UNOWNED,))
+_NO_OWNERS = _UNOWNED_BYTE * 10
+
+# utcnow_iso の結果を短時間キャッシュする（連続イベントで同じ時刻文字列を再利用）
+# [ミリ秒, 整形済み文字列]。クライアントは server_ts を時計合わせに使うため、
+# ミリ秒精度を保ったまま同じミリ秒内の呼び出しだけを使い回す
+_TS_CACHE: list = [-1, ""]
+
 def utcnow_iso() -> str:
         """
-        現在時刻を ISO8601 (UTC, 終端に 'Z') 形式で返す。
+        現在時刻を ISO8601 (UTC, ミリ秒精度, 終端に 'Z') 形式で返す。
 
-        - タイムゾーン情報を含む UTC 時刻を生成して、既存クライアントとの互換性のため
-            末尾を 'Z' に置換します。
+        - 既存クライアントとの互換性のため末尾は 'Z' にします。
         - 将来的な互換性のため、`utcnow()` の単純利用は避けています。
+        - 整形済み文字列はミリ秒単位でキャッシュします。同じミリ秒に発生した
+            イベントは同じタイムスタンプを共有します。
         """
-        dt = datetime.datetime.now(datetime.timezone.utc)
-        return dt.isoformat().replace("+00:00", "Z")
+        ms = time.time_ns() // 1_000_000
+        if _TS_CACHE[0] != ms:
+            _TS_CACHE[0] = ms
+            dt = datetime.datetime.fromtimestamp(ms // 1000, datetime.timezone.utc).replace(microsecond=ms % 1000 * 1000)
+            _TS_CACHE[1] = dt.isoformat(timespec="milliseconds").replace("+00:00", "Z")
+        return _TS_CACHE[1]
 
     # ---------------------------------------------------------------------------
     # ヘルパ関数
@@ -71,31 +116,116 @@ def utcnow_iso() -> str:
     # 変更する場合は挙動に注意してください（特に時刻形式など）。
     # ---------------------------------------------------------------------------
 
+_ALPHABET = string.ascii_letters + string.digits
+
+
 def gen_id(n: int = 6) -> str:
     """
     ランダムな英数字からなる識別子を生成するヘルパ。
 
-    デフォルト長は 6 文字。暗号学的に安全な `secrets.choice` を利用します。
+    デフォルト長は 6 文字。ルーム ID は公開される値で推測されても問題ないため、
+    `secrets` ではなく `random.choices` で 1 回の呼び出しにまとめて生成します。
     """
-    alphabet = string.ascii_letters + string.digits
-    return ''.join(secrets.choice(alphabet) for _ in range(n))
+    return ''.join(random.choices(_ALPHABET, k=n))
+
+
+def gen_token() -> str:
+    """
+    プレイヤー／観覧者 ID を生成するヘルパ。
+
+    player_id はアクション送信時の本人確認に使われるため推測できない必要があります。
+    そのため `random` ではなく、OS の乱数源から生成される `uuid4` を使います。
+    """
+    return uuid.uuid4().hex[:11]
 
 
 def find_player(room: Dict[str, Any], player_id: str) -> Optional[Dict[str, Any]]:
-    # room の players リストから player_id に一致するプレイヤー辞書を返す
+    # room の players_by_id 索引から player_id に一致するプレイヤー辞書を返す
     # 見つからなければ None を返却する
-    for p in room.get("players", []):
-        if p.get("player_id") == player_id:
-            return p
-    return None
+    return room["players_by_id"].get(player_id)
 
 
 def find_spectator(room: Dict[str, Any], spectator_id: str) -> Optional[Dict[str, Any]]:
-    # room の spectators リストから spectator_id に一致する観戦者を返す
-    for s in room.get("spectators", []):
-        if s.get("spectator_id") == spectator_id:
-            return s
-    return None
+    # room の spectators_by_id 索引から spectator_id に一致する観戦者を返す
+    return room["spectators_by_id"].get(spectator_id)
+
+
+def _owner_list(room: Dict[str, Any]) -> list:
+    """owners テーブルをクライアント向けの所有者名リスト（未所有は空文字）に変換する。"""
+    names = room["owner_names"]
+    return [names[c] if c != _UNOWNED else "" for c in room["owners"]]
+
+
+def _compact_owner_codes(room: Dict[str, Any]) -> None:
+    """
+    owners テーブルから参照されなくなったコードを回収し、使用中のコードを 0 から詰め直す。
+
+    札は 10 枚しかないので、詰め直した後のプールは高々 10 件になります。
+    """
+    owners = room["owners"]
+    names = room["owner_names"]
+    used = sorted(set(owners) - {_UNOWNED})
+    table = bytearray(_UNOWNED_BYTE * 256)
+    for new, old in enumerate(used):
+        table[old] = new
+    room["owners"][:] = owners.translate(table)
+    room["owner_names"] = [names[old] for old in used]
+    room["owner_codes"] = {name: new for new, name in enumerate(room["owner_names"])}
+
+
+def _owner_code(room: Dict[str, Any], name: str) -> int:
+    """所有者名に対応するコードを返す。初めて札を取った名前ならプールに追加する。"""
+    code = room["owner_codes"].get(name)
+    if code is None:
+        # 切断で解放された名前のコードはゲーム開始まで残るため、コードが _UNOWNED に
+        # 達する前に未使用のものを回収する（コードは常に _UNOWNED 未満に保つ）
+        if len(room["owner_names"]) >= _UNOWNED:
+            _compact_owner_codes(room)
+        code = room["owner_codes"][name] = len(room["owner_names"])
+        room["owner_names"].append(name)
+    return code
+
+
+def _invalidate_snapshot(room: Dict[str, Any]) -> None:
+    """
+    キャッシュ済みのスナップショットを破棄する。
+
+    - players/spectators/owners/play_sequence などを変更したハンドラの最後で呼びます。
+    - GET /rooms/{room_id} 用のキャッシュ `http_room_bytes` も合わせて破棄します。
+    """
+    room["snapshot_bytes"] = None
+    room["http_room_bytes"] = None
+
+
+def _snapshot_bytes(room: Dict[str, Any]) -> bytes:
+    """
+    ルームのスナップショットを orjson でエンコードした bytes を返す。
+
+    - 前回の変更以降に一度エンコードしていれば、保存済みのバイト列をそのまま返します。
+      変更が続いても送る相手がいなければエンコードは行われません。
+    - `next_event_id` はエンコード時点の値です。古くてもクライアントは差分イベントを
+      取得し直すだけなので問題ありません。
+    """
+    data = room["snapshot_bytes"]
+    if data is None:
+        snapshot = {
+            "type": "snapshot",
+            "room": {
+                # room_id / card_letters はゲーム開始時以外変わらないためテンプレートから展開する
+                **room["_snapshot_static"],
+                "players": list(room["players_by_id"].values()),
+                "spectators": list(room["spectators_by_id"].values()),
+                "owners": _owner_list(room),
+                "play_sequence": room["play_sequence"],
+                "started": room["started"],
+                "play_at": room["play_at"],
+                "play_idx": room["play_idx"],
+            },
+            "next_event_id": room["next_event_id"],
+        }
+        data = room["snapshot_bytes"] = orjson.dumps(snapshot)
+    return data
+
 
 def make_room(max_players: int = 2) -> Dict[str, Any]:
     """
@@ -112,32 +242,47 @@ def make_room(max_players: int = 2) -> Dict[str, Any]:
             break
     now = utcnow_iso()
     # このルーム用に 0..99 の中から 10 個のカード ID をランダムに選ぶ
-    card_letters = random.sample(list(range(100)), 10)
+    card_letters = random.sample(_DECK, 10)
 
     # 新しいルーム状態を初期化して返す
     room = {
         "room_id": room_id,
         "created_at": now,
-        "players": [],
-        "spectators": [],
-        # owners: 10 枚のカードそれぞれの所有者名（未所有は空文字）
-        "owners": ["" for _ in range(10)],
+        # players/spectators: id -> エントリ。dict は挿入順を保つので参加順の一覧を兼ねる
+        "players_by_id": {},
+        "spectators_by_id": {},
+        # free_slots: 空いているスロット番号の最小ヒープ（heapq で管理）
+        "free_slots": list(range(max_players)),
+        # owners: 10 枚のカードそれぞれの所有者コード（未所有は _UNOWNED）
+        # owner_names / owner_codes: コード <-> 所有者名（ゲーム開始時にリセット）
+        "owners": bytearray(_NO_OWNERS),
+        "owner_names": [],
+        "owner_codes": {},
+        # taken_count / counts: owners から導出される集計を増分管理したもの
+        "taken_count": 0,
+        "counts": {},
         # card_letters: 各カードに対応する数値 ID
         "card_letters": card_letters,
         # penalties: player_name -> penalty count (mistakes)
         "penalties": {},
         # play_sequence: list of { "cardPos": int|null, "letter": int }
         "play_sequence": [],
+        # play_at: 再生開始予定時刻（ISO8601、未開始なら None）
+        "play_at": None,
         # play coordination: current index and ack set per index
         "play_idx": 0,
         "play_acks": {},
         # whether a game in this room has been started
         "started": False,
-        "events": [],
+        "events": deque(maxlen=MAX_EVENTS_PER_ROOM),
         "next_event_id": 1,
         "meta": {"max_players": max_players},
-        "connections": set(),
-        "lock": asyncio.Lock(),
+        "connections": {},
+        # snapshot のうちほぼ不変な部分（card_letters はゲーム開始時に差し替える）
+        "_snapshot_static": {"room_id": room_id, "card_letters": card_letters},
+        # エンコード済みスナップショットのキャッシュ（変更時に _invalidate_snapshot で破棄）
+        "snapshot_bytes": None,
+        "http_room_bytes": None,
     }
     rooms[room_id] = room
     return room
@@ -150,23 +295,33 @@ def create_room_with_id(room_id: str, max_players: int = 2) -> Dict[str, Any]:
     if room_id in rooms:
         return rooms[room_id]
     now = utcnow_iso()
-    card_letters = random.sample(list(range(100)), 10)
+    card_letters = random.sample(_DECK, 10)
     # 指定の room_id を使ってルームを作る（存在すれば既存のものを返す）
     room = {
         "room_id": room_id,
         "created_at": now,
-        "players": [],
-        "spectators": [],
-        "owners": ["" for _ in range(10)],
+        "players_by_id": {},
+        "spectators_by_id": {},
+        "free_slots": list(range(max_players)),
+        "owners": bytearray(_NO_OWNERS),
+        "owner_names": [],
+        "owner_codes": {},
+        "taken_count": 0,
+        "counts": {},
         "card_letters": card_letters,
         "penalties": {},
         "play_sequence": [],
+        "play_at": None,
+        "play_idx": 0,
+        "play_acks": {},
         "started": False,
-        "events": [],
+        "events": deque(maxlen=MAX_EVENTS_PER_ROOM),
         "next_event_id": 1,
         "meta": {"max_players": max_players},
-        "connections": set(),
-        "lock": asyncio.Lock(),
+        "connections": {},
+        "_snapshot_static": {"room_id": room_id, "card_letters": card_letters},
+        "snapshot_bytes": None,
+        "http_room_bytes": None,
     }
     rooms[room_id] = room
     return room
@@ -184,12 +339,15 @@ def ensure_fixed_rooms(prefix: str = 'room', count: int = 10):
 # Create fixed rooms at module import so they are always available
 ensure_fixed_rooms('room', 10)
 
-def add_event(room: Dict[str, Any], etype: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+def add_event(room: Dict[str, Any], etype: str, payload: Dict[str, Any]) -> bytes:
     """
-    指定ルームにイベントを追加して、そのイベントオブジェクトを返す。
+    指定ルームにイベントを追加して、ブロードキャスト用にエンコード済みのメッセージを返す。
 
-    - `events` は最大長 `MAX_EVENTS_PER_ROOM` を超えたら古いイベントを切り捨てます。
-    - 返却されるイベントには `id`, `type`, `payload`, `ts` が含まれます。
+    - `events` は maxlen=`MAX_EVENTS_PER_ROOM` の deque なので、上限を超えると
+      古いイベントが自動的に捨てられます。
+    - 保存されるイベントには `id`, `type`, `payload`, `ts` が含まれます。
+    - 返却値は `{"type", "id", "payload"}` を orjson でエンコードした bytes で、
+      そのまま `publish()` に渡せます。呼び出し側で中間の dict を作る必要はありません。
     """
     eid = room["next_event_id"]
     server_ts = utcnow_iso()
@@ -197,10 +355,7 @@ def add_event(room: Dict[str, Any], etype: str, payload: Dict[str, Any]) -> Dict
     evt = {"id": eid, "seq": eid, "type": etype, "payload": payload, "ts": server_ts, "server_ts": server_ts}
     room["events"].append(evt)
     room["next_event_id"] += 1
-    if len(room["events"]) > MAX_EVENTS_PER_ROOM:
-        drop = len(room["events"]) - MAX_EVENTS_PER_ROOM
-        room["events"] = room["events"][drop:]
-    return evt
+    return orjson.dumps({"type": etype, "id": eid, "payload": payload})
 
 # ---------------------------------------------------------------------------
 # ブロードキャスト／WebSocket 処理
@@ -208,44 +363,155 @@ def add_event(room: Dict[str, Any], etype: str, payload: Dict[str, Any]) -> Dict
 # ルーム単位のブロードキャストを行う主要なロジックです。
 # ---------------------------------------------------------------------------
 
-async def broadcast(room: Dict[str, Any], message: Dict[str, Any]):
+async def _client_writer(websocket: WebSocket, queue: asyncio.Queue):
     """
-    ルーム内のすべての接続に JSON メッセージをブロードキャストする。
-
-    - 送信に失敗した接続は切断済みと判断してルームの接続集合から削除します。
-    - 実際の送信は await されるため呼び出し側は非同期コンテキストで呼んでください。
+    接続ごとの送信ループ。送信キューに積まれたバイト列を順番に送る。
+
+    - ハンドラや publish() はキューに積むだけなので、遅いクライアントへの送信が
+      受信処理やルーム内の他の接続への配信を待たせません。
+    - 送信中に次のメッセージが溜まっていれば、待ち時間を入れずにそれらを
+      `{"type": "batch", "events": [...]}` の 1 フレームにまとめて送ります。
+      溜まっていなければ従来どおりメッセージ単体を送ります。
+    - int が積まれた場合はそれをクローズコードとして接続を閉じ、終了します。
+    - 送信に失敗した場合も終了します。ルームからの削除は websocket_endpoint の finally で行います。
     """
-    conns: Set[WebSocket] = set(room.get("connections", set()))
-    to_remove = []
-    for ws in conns:
+    try:
+        while True:
+            data = await queue.get()
+            close_code = data if isinstance(data, int) else None
+            if close_code is None and not queue.empty():
+                batch = [data]
+                while True:
+                    try:
+                        item = queue.get_nowait()
+                    except asyncio.QueueEmpty:
+                        break
+                    if isinstance(item, int):
+                        close_code = item
+                        break
+                    batch.append(item)
+                # 各要素はエンコード済みの JSON なので、再エンコードせずに連結する
+                data = batch[0] if len(batch) == 1 else b'{"type":"batch","events":[' + b",".join(batch) + b"]}"
+            if not isinstance(data, int):
+                await websocket.send_bytes(data)
+            if close_code is not None:
+                await websocket.close(code=close_code)
+                return
+    except Exception as e:
+        logger.debug("writer: failed to send to websocket: %s", e)
+
+
+def _kick(queue: asyncio.Queue, code: int = 1008) -> None:
+    """未送信のメッセージを捨て、送信ループに接続を閉じさせる。"""
+    while True:
         try:
-            await ws.send_json(message)
-        except Exception as e:
-            # 送信失敗（接続切断等）とみなし、後で集合から削除する
-            logger.debug("broadcast: failed to send to websocket: %s", e)
-            to_remove.append(ws)
-            try:
-                await ws.close()
-            except Exception:
-                pass
-    if to_remove:
-        async with room["lock"]:
-            for ws in to_remove:
-                room["connections"].discard(ws)
+            queue.get_nowait()
+        except asyncio.QueueEmpty:
+            break
+    queue.put_nowait(code)
+
+
+def _enqueue(queue: asyncio.Queue, data: Union[bytes, int]) -> bool:
+    """
+    送信キューにデータを積む。
+
+    キューがあふれている（クライアントが受信に追いついていない）場合は `_kick` で
+    切断を予約して False を返します。
+    """
+    try:
+        queue.put_nowait(data)
+        return True
+    except asyncio.QueueFull:
+        _kick(queue)
+        return False
+
+
+def publish(room: Dict[str, Any], message: Union[Dict[str, Any], bytes]) -> None:
+    """
+    ルーム内のすべての接続の送信キューに JSON メッセージを積む。
+
+    - 宛先はこの呼び出し時点の接続集合で決まります。後から参加したクライアントが、
+      自分のスナップショットに含まれる古いイベントを受け取ることはありません。
+    - メッセージは orjson で一度だけエンコードし、同じバイト列を全接続へ送ります。
+      エンコード済みの bytes を渡した場合はそのまま送ります。
+    - 実際の送信とバッチ化は接続ごとの `_client_writer` が行うため、呼び出し側は
+      送信完了を待たず、遅いクライアントが他の接続への配信を待たせることもありません。
+    - 既に CONNECTED 状態でない接続と、送信キューがあふれて切断した接続は
+      ルームの接続集合から削除します。
+    - 失敗してもログに残すだけで例外は送出しないため、呼び出し側での try は不要です。
+    """
+    try:
+        data = message if isinstance(message, bytes) else orjson.dumps(message)
+        conns: Dict[WebSocket, asyncio.Queue] = room["connections"]
+        to_remove = []
+        for ws, queue in conns.items():
+            if ws.application_state is not WebSocketState.CONNECTED or ws.client_state is not WebSocketState.CONNECTED:
+                to_remove.append(ws)
+            elif not _enqueue(queue, data):
+                logger.info("publish: disconnecting slow client in room %s (send queue full)", room["room_id"])
+                to_remove.append(ws)
+        for ws in to_remove:
+            conns.pop(ws, None)
+    except Exception:
+        logger.exception("publish: failed to enqueue message for room %s", room["room_id"])
+
+
+@functools.lru_cache(maxsize=None)
+def encode_error(error: str) -> bytes:
+    """
+    エラーメッセージ `{"type": "error", "error": ...}` をエンコードして返す。
+
+    エラー文言は固定の文字列なので、エンコード結果をキャッシュして使い回します。
+    """
+    return orjson.dumps({"type": "error", "error": error})
+
+
+def json_response(content: Any, status_code: int = 200) -> Response:
+    """
+    orjson でエンコードした JSON レスポンスを返す。
+
+    HTTP の JSON レスポンスはすべてこれを通し、FastAPI 側での再エンコードや
+    非推奨になった ORJSONResponse に依存しないようにします。
+    """
+    return Response(content=orjson.dumps(content), status_code=status_code, media_type="application/json")
+
+
+async def receive_message(websocket: WebSocket) -> Any:
+    """
+    クライアントから 1 フレーム受信し、orjson でデコードして返す。
+
+    - テキスト／バイナリどちらのフレームも受け付けます。
+    - 切断フレームを受け取った場合は `receive_json` と同様に `WebSocketDisconnect` を送出します。
+    - JSON として不正な場合は `orjson.JSONDecodeError` を送出します。
+    """
+    msg = await websocket.receive()
+    if msg["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(msg.get("code", 1000), msg.get("reason"))
+    raw = msg.get("bytes")
+    if raw is None:
+        raw = msg.get("text") or ""
+    return orjson.loads(raw)
+
 
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
+    # この接続への送信はすべて送信キュー経由で _client_writer が行う
+    outq: asyncio.Queue = asyncio.Queue(maxsize=CLIENT_SEND_QUEUE_MAX)
+    writer = asyncio.create_task(_client_writer(websocket, outq))
+    send = functools.partial(_enqueue, outq)
     room = None
     client_meta = {}
     pass_evt = None
     try:
         # 最初にクライアントからの join メッセージを待つ
         # 仕様: {"type": "join", "room_id": null|str, "role": "player"|"spectator", "name": "..."}
-        msg = await websocket.receive_json()
+        try:
+            msg = await receive_message(websocket)
+        except orjson.JSONDecodeError:
+            msg = None
         if not isinstance(msg, dict) or msg.get("type") != "join":
-            await websocket.send_json({"type": "error", "error": "first message must be join"})
-            await websocket.close()
+            send(encode_error("first message must be join"))
             return
 
         room_id = msg.get("room_id")
@@ -259,62 +525,49 @@ async def websocket_endpoint(websocket: WebSocket):
         else:
             room = rooms.get(room_id)
             if room is None:
-                await websocket.send_json({"type": "error", "error": "room not found"})
-                await websocket.close()
+                send(encode_error("room not found"))
                 return
 
-        async with room["lock"]:
-            # 接続を登録
-            room["connections"].add(websocket)
-            if role == "player":
-                # プレイヤーとして参加。満員なら拒否
-                if len(room["players"]) >= room["meta"].get("max_players", 2):
-                    await websocket.send_json({"type": "error", "error": "room full"})
-                    room["connections"].discard(websocket)
-                    await websocket.close()
-                    return
-                player_id = secrets.token_urlsafe(8)
-                used_slots = {p.get("slot") for p in room.get("players", []) if p.get("slot") is not None}
-                slot = 0
-                while slot in used_slots:
-                    slot += 1
-                p = {"player_id": player_id, "name": name, "joined_at": utcnow_iso(), "slot": slot}
-                room["players"].append(p)
-                evt = add_event(room, "player_joined", {"player_id": player_id, "name": name, "slot": slot})
-                client_meta = {"role": "player", "player_id": player_id, "name": name}
-            else:
-                # 観覧者として参加
-                spectator_id = secrets.token_urlsafe(8)
-                s = {"spectator_id": spectator_id, "name": name, "joined_at": utcnow_iso()}
-                room["spectators"].append(s)
-                evt = add_event(room, "spectator_joined", {"spectator_id": spectator_id, "name": name})
-                client_meta = {"role": "spectator", "spectator_id": spectator_id, "name": name}
+        # プレイヤーとして参加する場合、空きスロットがなければ接続を登録する前に拒否
+        if role == "player" and not room["free_slots"]:
+            send(encode_error("room full"))
+            return
+
+        # 接続を登録
+        room["connections"][websocket] = outq
+        if role == "player":
+            player_id = gen_token()
+            slot = heapq.heappop(room["free_slots"])
+            p = {"player_id": player_id, "name": name, "joined_at": utcnow_iso(), "slot": slot}
+            room["players_by_id"][player_id] = p
+            evt = add_event(room, "player_joined", {"player_id": player_id, "name": name, "slot": slot})
+            client_meta = {"role": "player", "player_id": player_id, "name": name}
+        else:
+            # 観覧者として参加
+            spectator_id = gen_token()
+            s = {"spectator_id": spectator_id, "name": name, "joined_at": utcnow_iso()}
+            room["spectators_by_id"][spectator_id] = s
+            evt = add_event(room, "spectator_joined", {"spectator_id": spectator_id, "name": name})
+            client_meta = {"role": "spectator", "spectator_id": spectator_id, "name": name}
+        _invalidate_snapshot(room)
 
         # スナップショットと参加確認を送信
-        snapshot = {
-            "type": "snapshot",
-            "room": {
-                    "room_id": room["room_id"],
-                    "players": room["players"],
-                    "spectators": room["spectators"],
-                    "owners": room.get("owners", []),
-                    "card_letters": room.get("card_letters", []),
-                    "play_sequence": room.get("play_sequence", []),
-                    "started": room.get("started", False),
-                    "play_at": room.get("play_at", None),
-                    "play_idx": room.get("play_idx", 0),
-            },
-            "next_event_id": room["next_event_id"],
-        }
-        await websocket.send_json({"type": "joined", "room_id": room["room_id"], "you": client_meta})
-        await websocket.send_json(snapshot)
+        send(orjson.dumps({"type": "joined", "room_id": room["room_id"], "you": client_meta}))
+        send(_snapshot_bytes(room))
 
         # 参加イベントをブロードキャスト
-        await broadcast(room, {"type": evt["type"], "id": evt["id"], "payload": evt["payload"]})
+        publish(room, evt)
 
         # メイン受信ループ: クライアントからの action/chat/leave を処理
+        # ループ内で毎回参照する関数・メソッドはローカル変数に束縛しておく
+        recv = receive_message
+        pub = publish
+        add = add_event
         while True:
-            data = await websocket.receive_json()
+            try:
+                data = await recv(websocket)
+            except orjson.JSONDecodeError:
+                continue
             if not isinstance(data, dict):
                 continue
             t = data.get("type")
@@ -325,309 +578,276 @@ async def websocket_endpoint(websocket: WebSocket):
                 payload = data.get("payload", {})
                 # index to notify play_continue for (calculated when a card is taken)
                 play_continue_idx = None
-                async with room["lock"]:
-                    found = find_player(room, player_id)
-                    if not found:
-                        await websocket.send_json({"type": "error", "error": "player not in room or invalid id"})
+                fin_evt = None
+                found = find_player(room, player_id)
+                if not found:
+                    send(encode_error("player not in room or invalid id"))
+                    continue
+                # 特殊アクション: take（カード取得）
+                if action == "take":
+                    cid = payload.get("id")
+                    if not isinstance(cid, int) or cid < 0 or cid >= len(room["owners"]):
+                        send(encode_error("invalid card id"))
+                        continue
+                    player_name = payload.get("player") or found.get("name")
+                    if room["owners"][cid] != _UNOWNED:
+                        send(encode_error("card already taken"))
                         continue
-                    # 特殊アクション: take（カード取得）
-                    if action == "take":
-                        cid = payload.get("id")
-                        if not isinstance(cid, int) or cid < 0 or cid >= len(room.get("owners", [])):
-                            await websocket.send_json({"type": "error", "error": "invalid card id"})
-                            continue
-                        player_name = payload.get("player") or found.get("name")
-                        if room["owners"][cid]:
-                            await websocket.send_json({"type": "error", "error": "card already taken"})
-                            continue
-                        room["owners"][cid] = player_name
-                        evt = add_event(room, "player_action", {"player_id": player_id, "action": action, "payload": {"id": cid, "player": player_name}})
-                        # determine if this taken card corresponds to current play_sequence index
-                        try:
-                            seq = room.get("play_sequence") or []
-                            for i, itm in enumerate(seq):
-                                if isinstance(itm, dict) and itm.get("cardPos") == cid:
-                                    # if this index is the current play index or earlier, signal continue
-                                    # advance room play_idx to next
-                                    if room.get("play_idx", 0) <= i:
-                                        room["play_idx"] = i + 1
-                                        play_continue_idx = i
+                    room["owners"][cid] = _owner_code(room, player_name)
+                    room["taken_count"] += 1
+                    room["counts"][player_name] = room["counts"].get(player_name, 0) + 1
+                    evt = add(room, "player_action", {"player_id": player_id, "action": action, "payload": {"id": cid, "player": player_name}})
+                    # determine if this taken card corresponds to current play_sequence index
+                    try:
+                        seq = room["play_sequence"]
+                        for i, itm in enumerate(seq):
+                            if isinstance(itm, dict) and itm.get("cardPos") == cid:
+                                # if this index is the current play index or earlier, signal continue
+                                # advance room play_idx to next
+                                if room["play_idx"] <= i:
+                                    room["play_idx"] = i + 1
+                                    play_continue_idx = i
+                                break
+                    except Exception:
+                        play_continue_idx = None
+                    # After taking, check if enough cards are taken -> finish game
+                    taken_count = room["taken_count"]
+                    # finish when 9 or more cards have been taken (ユーザ要求)
+                    if taken_count >= 9:
+                        # count cards per player name
+                        counts = dict(room["counts"])
+                        # apply penalties (subtract mistakes) recorded in room['penalties']
+                        penalties = room["penalties"]
+                        for pname, pen in penalties.items():
+                            if pname in counts:
+                                counts[pname] = max(0, counts.get(pname, 0) - int(pen))
+                        # determine winner(s)
+                        max_count = 0
+                        winners = []
+                        for name, cnt in counts.items():
+                            if cnt > max_count:
+                                max_count = cnt
+                                winners = [name]
+                            elif cnt == max_count:
+                                winners.append(name)
+                        # choose label A/B by player slot if possible
+                        winner_label = None
+                        winner_name = None
+                        if len(winners) == 1:
+                            winner_name = winners[0]
+                            # find player with that name to get slot
+                            for p in room["players_by_id"].values():
+                                if p.get("name") == winner_name:
+                                    slot = p.get("slot")
+                                    if slot is not None:
+                                        # map 0 -> A, 1 -> B, others -> ?
+                                        winner_label = chr(ord('A') + int(slot)) if isinstance(slot, int) and slot >= 0 else None
                                     break
-                        except Exception:
-                            play_continue_idx = None
-                        # After taking, check if enough cards are taken -> finish game
-                        taken_count = sum(1 for o in room.get("owners", []) if o)
-                        # finish when 9 or more cards have been taken (ユーザ要求)
-                        if taken_count >= 9:
-                            # count cards per player name
-                            counts = {}
-                            for o in room.get("owners", []):
-                                if o:
-                                    counts[o] = counts.get(o, 0) + 1
-                            # apply penalties (subtract mistakes) recorded in room['penalties']
-                            penalties = room.get("penalties", {}) or {}
-                            for pname, pen in penalties.items():
-                                if pname in counts:
-                                    counts[pname] = max(0, counts.get(pname, 0) - int(pen))
-                            # determine winner(s)
-                            max_count = 0
-                            winners = []
-                            for name, cnt in counts.items():
-                                if cnt > max_count:
-                                    max_count = cnt
-                                    winners = [name]
-                                elif cnt == max_count:
-                                    winners.append(name)
-                            # choose label A/B by player slot if possible
-                            winner_label = None
+                        else:
+                            # tie
                             winner_name = None
-                            if len(winners) == 1:
-                                winner_name = winners[0]
-                                # find player with that name to get slot
-                                for p in room.get("players", []):
-                                    if p.get("name") == winner_name:
-                                        slot = p.get("slot")
-                                        if slot is not None:
-                                            # map 0 -> A, 1 -> B, others -> ?
-                                            winner_label = chr(ord('A') + int(slot)) if isinstance(slot, int) and slot >= 0 else None
-                                        break
-                            else:
-                                # tie
-                                winner_name = None
-                            # mark game as not started (finished)
-                            room["started"] = False
-                            payload_fin = {"winner": winner_name, "winner_label": winner_label, "counts": counts}
-                            fin_evt = add_event(room, "game_finished", payload_fin)
-                    elif action == "mistake":
-                        # Player clicked wrong card (penalty)
-                        player_name = found.get("name")
-                        # increment penalty counter for this player name
-                        cur = room.get("penalties", {}) or {}
-                        cur[player_name] = cur.get(player_name, 0) + 1
-                        room["penalties"] = cur
-                        evt = add_event(room, "player_penalty", {"player_id": player_id, "player": player_name, "penalties": cur[player_name]})
-                    elif action == "start":
-                        # Start a new game in the room: reset owners and deal new card letters
-                        # Only allow if sender is a valid player (checked above)
-                        player_name = found.get("name")
-                        # reset ownership and deal new card letters
-                        room["owners"] = ["" for _ in range(10)]
-                        room["card_letters"] = random.sample(list(range(100)), 10)
-                        # build a play sequence: include the 10 table cards (with positions) and 9 random off-table letters
-                        table_letters = room["card_letters"]
-                        seq = []
-                        present = set([int(x) for x in table_letters])
-                        for i, lt in enumerate(table_letters):
-                            seq.append({"cardPos": i, "letter": int(lt)})
-                        pool = [v for v in range(100) if v not in present]
-                        random.shuffle(pool)
-                        extra = pool[:9]
-                        for v in extra:
-                            seq.append({"cardPos": None, "letter": int(v)})
-                        random.shuffle(seq)
-                        room["play_sequence"] = seq
-                        # reset play coordination
-                        room["play_idx"] = 0
-                        room["play_acks"] = {}
-                        # reset penalties at start of new game
-                        room["penalties"] = {}
-                        room["started"] = True
-                        # schedule playback slightly in the future so clients have time to prepare
-                        try:
-                            play_delay_ms = 500
-                            play_at_dt = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(milliseconds=play_delay_ms)
-                            play_at = play_at_dt.isoformat().replace("+00:00", "Z")
-                        except Exception:
-                            play_at = utcnow_iso()
-                        # store play_at in room so late joiners receive synchronization info
-                        room["play_at"] = play_at
-
-                        evt = add_event(room, "game_started", {"player_id": player_id, "player": player_name, "play_sequence": room.get("play_sequence", []), "play_at": play_at})
-                        # prepare snapshot to broadcast
-                        snapshot = {
-                            "type": "snapshot",
-                            "room": {
-                                "room_id": room["room_id"],
-                                "players": room["players"],
-                                "spectators": room["spectators"],
-                                "owners": room.get("owners", []),
-                                "card_letters": room.get("card_letters", []),
-                                "play_sequence": room.get("play_sequence", []),
-                                "started": room.get("started", False),
-                                "play_at": room.get("play_at", None),
-                                "play_idx": room.get("play_idx", 0),
-                            },
-                            "next_event_id": room["next_event_id"],
-                        }
-                    else:
-                        evt = add_event(room, "player_action", {"player_id": player_id, "action": action, "payload": payload})
+                        # mark game as not started (finished)
+                        room["started"] = False
+                        payload_fin = {"winner": winner_name, "winner_label": winner_label, "counts": counts}
+                        fin_evt = add(room, "game_finished", payload_fin)
+                    _invalidate_snapshot(room)
+                elif action == "mistake":
+                    # Player clicked wrong card (penalty)
+                    player_name = found.get("name")
+                    # increment penalty counter for this player name
+                    cur = room["penalties"]
+                    cur[player_name] = cur.get(player_name, 0) + 1
+                    evt = add(room, "player_penalty", {"player_id": player_id, "player": player_name, "penalties": cur[player_name]})
+                elif action == "start":
+                    # Start a new game in the room: reset owners and deal new card letters
+                    # Only allow if sender is a valid player (checked above)
+                    player_name = found.get("name")
+                    # reset ownership and deal new card letters
+                    # reuse the existing containers instead of allocating new ones per game
+                    room["owners"][:] = _NO_OWNERS
+                    room["owner_names"].clear()
+                    room["owner_codes"].clear()
+                    room["taken_count"] = 0
+                    room["counts"].clear()
+                    # 場の 10 枚と場にない読み札 9 枚を、1 回の sample で重複なく選ぶ
+                    dealt = random.sample(_DECK, 19)
+                    room["card_letters"] = dealt[:10]
+                    room["_snapshot_static"]["card_letters"] = room["card_letters"]
+                    # build a play sequence: include the 10 table cards (with positions) and 9 random off-table letters
+                    table_letters = room["card_letters"]
+                    seq = []
+                    for i, lt in enumerate(table_letters):
+                        seq.append({"cardPos": i, "letter": int(lt)})
+                    extra = dealt[10:]
+                    for v in extra:
+                        seq.append({"cardPos": None, "letter": int(v)})
+                    random.shuffle(seq)
+                    room["play_sequence"] = seq
+                    # reset play coordination
+                    room["play_idx"] = 0
+                    room["play_acks"] = {}
+                    # reset penalties at start of new game
+                    room["penalties"].clear()
+                    room["started"] = True
+                    # schedule playback slightly in the future so clients have time to prepare
+                    try:
+                        play_delay_ms = 500
+                        play_at_dt = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(milliseconds=play_delay_ms)
+                        play_at = play_at_dt.isoformat().replace("+00:00", "Z")
+                    except Exception:
+                        play_at = utcnow_iso()
+                    # store play_at in room so late joiners receive synchronization info
+                    room["play_at"] = play_at
+
+                    evt = add(room, "game_started", {"player_id": player_id, "player": player_name, "play_sequence": room["play_sequence"], "play_at": play_at})
+                    # prepare snapshot to broadcast
+                    _invalidate_snapshot(room)
+                    snapshot = _snapshot_bytes(room)
+                else:
+                    evt = add(room, "player_action", {"player_id": player_id, "action": action, "payload": payload})
                 # broadcast event
-                await broadcast(room, {"type": evt["type"], "id": evt["id"], "payload": evt["payload"]})
+                pub(room, evt)
                 # if finish event was created, broadcast it
-                try:
-                    if 'fin_evt' in locals():
-                        await broadcast(room, {"type": fin_evt["type"], "id": fin_evt["id"], "payload": fin_evt["payload"]})
-                except Exception:
-                    pass
+                if fin_evt is not None:
+                    pub(room, fin_evt)
                 # If we determined a play_continue index (card was taken and matches sequence), broadcast it
-                try:
-                    if play_continue_idx is not None:
-                        await broadcast(room, {"type": "play_continue", "index": play_continue_idx})
-                except Exception:
-                    pass
+                if play_continue_idx is not None:
+                    pub(room, {"type": "play_continue", "index": play_continue_idx})
                 # if start, broadcast snapshot as well (clients will use play_at to sync start)
                 if action == "start":
-                    await broadcast(room, snapshot)
+                    pub(room, snapshot)
             elif t == "become_player":
                 # spectator -> player 昇格リクエスト
                 # クライアント側は通常ボタン押下でこのメッセージを送る
-                async with room["lock"]:
-                    # identify spectator by client_meta first, fallback to provided id
-                    sid = client_meta.get("spectator_id") or data.get("spectator_id")
-                    if not sid:
-                        await websocket.send_json({"type": "error", "error": "not a spectator or missing id"})
-                        continue
-                    # ensure spectator exists
-                    spec = None
-                    for s in room.get("spectators", []):
-                        if s.get("spectator_id") == sid:
-                            spec = s
-                            break
-                    if not spec:
-                        await websocket.send_json({"type": "error", "error": "spectator not found"})
-                        continue
-                    # check room capacity
-                    if len(room.get("players", [])) >= room["meta"].get("max_players", 2):
-                        await websocket.send_json({"type": "error", "error": "room full"})
-                        continue
-                    # create player entry
-                    player_id = secrets.token_urlsafe(8)
-                    used_slots = {p.get("slot") for p in room.get("players", []) if p.get("slot") is not None}
-                    slot = 0
-                    while slot in used_slots:
-                        slot += 1
-                    pname = spec.get("name") or data.get("name") or "(anonymous)"
-                    p = {"player_id": player_id, "name": pname, "joined_at": utcnow_iso(), "slot": slot}
-                    room["players"].append(p)
-                    # remove spectator
-                    room["spectators"] = [x for x in room.get("spectators", []) if x.get("spectator_id") != sid]
-                    # update client_meta
-                    client_meta = {"role": "player", "player_id": player_id, "name": pname}
-                    evt = add_event(room, "player_joined", {"player_id": player_id, "name": pname, "slot": slot})
+                # identify spectator by client_meta first, fallback to provided id
+                sid = client_meta.get("spectator_id") or data.get("spectator_id")
+                if not sid:
+                    send(encode_error("not a spectator or missing id"))
+                    continue
+                # ensure spectator exists
+                spec = find_spectator(room, sid)
+                if not spec:
+                    send(encode_error("spectator not found"))
+                    continue
+                # check room capacity (no free slot left)
+                if not room["free_slots"]:
+                    send(encode_error("room full"))
+                    continue
+                # create player entry
+                player_id = gen_token()
+                slot = heapq.heappop(room["free_slots"])
+                pname = spec.get("name") or data.get("name") or "(anonymous)"
+                p = {"player_id": player_id, "name": pname, "joined_at": utcnow_iso(), "slot": slot}
+                room["players_by_id"][player_id] = p
+                # remove spectator
+                room["spectators_by_id"].pop(sid)
+                # update client_meta
+                client_meta = {"role": "player", "player_id": player_id, "name": pname}
+                evt = add(room, "player_joined", {"player_id": player_id, "name": pname, "slot": slot})
+                _invalidate_snapshot(room)
                 # notify the requester and broadcast
-                await websocket.send_json({"type": "promoted", "you": client_meta})
+                send(orjson.dumps({"type": "promoted", "you": client_meta}))
                 # optional: send updated snapshot to the promoted client
-                await websocket.send_json({"type": "snapshot", "room": {"room_id": room["room_id"], "players": room["players"], "spectators": room["spectators"], "owners": room.get("owners", []), "card_letters": room.get("card_letters", []), "play_sequence": room.get("play_sequence", []), "started": room.get("started", False), "play_at": room.get("play_at", None), "play_idx": room.get("play_idx", 0)}, "next_event_id": room["next_event_id"]})
-                await broadcast(room, {"type": evt["type"], "id": evt["id"], "payload": evt["payload"]})
+                send(_snapshot_bytes(room))
+                pub(room, evt)
             elif t == "become_spectator":
                 # player -> spectator 昇格（退席して観覧者になる）
-                async with room["lock"]:
-                    pid = client_meta.get("player_id") or data.get("player_id")
-                    if not pid:
-                        await websocket.send_json({"type": "error", "error": "not a player or missing id"})
-                        continue
-                    # find player
-                    found = None
-                    for p in room.get("players", []):
-                        if p.get("player_id") == pid:
-                            found = p
-                            break
-                    if not found:
-                        await websocket.send_json({"type": "error", "error": "player not found"})
-                        continue
-                    pname = found.get("name")
-                    # create spectator entry
-                    spectator_id = secrets.token_urlsafe(8)
-                    s = {"spectator_id": spectator_id, "name": pname, "joined_at": utcnow_iso()}
-                    room["spectators"].append(s)
-                    # remove player from players list
-                    room["players"] = [p for p in room.get("players", []) if p.get("player_id") != pid]
-                    # update client_meta
-                    client_meta = {"role": "spectator", "spectator_id": spectator_id, "name": pname}
-                    evt_left = add_event(room, "player_left", {"player_id": pid})
-                    evt_spec = add_event(room, "spectator_joined", {"spectator_id": spectator_id, "name": pname})
+                pid = client_meta.get("player_id") or data.get("player_id")
+                if not pid:
+                    send(encode_error("not a player or missing id"))
+                    continue
+                # find player
+                found = find_player(room, pid)
+                if not found:
+                    send(encode_error("player not found"))
+                    continue
+                pname = found.get("name")
+                # create spectator entry
+                spectator_id = gen_token()
+                s = {"spectator_id": spectator_id, "name": pname, "joined_at": utcnow_iso()}
+                room["spectators_by_id"][spectator_id] = s
+                # remove player entry
+                room["players_by_id"].pop(pid)
+                heapq.heappush(room["free_slots"], found["slot"])
+                # update client_meta
+                client_meta = {"role": "spectator", "spectator_id": spectator_id, "name": pname}
+                evt_left = add(room, "player_left", {"player_id": pid})
+                evt_spec = add(room, "spectator_joined", {"spectator_id": spectator_id, "name": pname})
+                _invalidate_snapshot(room)
                 # notify requester and broadcast
-                await websocket.send_json({"type": "demoted", "you": client_meta})
-                await websocket.send_json({"type": "snapshot", "room": {"room_id": room["room_id"], "players": room["players"], "spectators": room["spectators"], "owners": room.get("owners", []), "card_letters": room.get("card_letters", []), "play_sequence": room.get("play_sequence", []), "started": room.get("started", False), "play_at": room.get("play_at", None), "play_idx": room.get("play_idx", 0)}, "next_event_id": room["next_event_id"]})
-                await broadcast(room, {"type": evt_left["type"], "id": evt_left["id"], "payload": evt_left["payload"]})
-                await broadcast(room, {"type": evt_spec["type"], "id": evt_spec["id"], "payload": evt_spec["payload"]})
+                send(orjson.dumps({"type": "demoted", "you": client_meta}))
+                send(_snapshot_bytes(room))
+                pub(room, evt_left)
+                pub(room, evt_spec)
             elif t == "chat":
                 # チャットメッセージ処理: payload に {"message": "..."} を期待
                 payload = data.get("payload", {})
                 msg_text = payload.get("message")
                 if not isinstance(msg_text, str):
-                    await websocket.send_json({"type": "error", "error": "invalid chat payload"})
+                    send(encode_error("invalid chat payload"))
                     continue
                 sender_name = None
-                async with room["lock"]:
-                    pid = data.get("player_id")
-                    if pid:
-                        p = find_player(room, pid)
-                        if p:
-                            sender_name = p.get("name")
-                    if sender_name is None:
-                        sid = data.get("spectator_id")
-                        if sid:
-                            s = find_spectator(room, sid)
-                            if s:
-                                sender_name = s.get("name")
-                    if sender_name is None:
-                        sender_name = data.get("name") or "(anonymous)"
-                    evt = add_event(room, "chat_message", {"from": sender_name, "message": msg_text})
-                await broadcast(room, {"type": evt["type"], "id": evt["id"], "payload": evt["payload"]})
+                pid = data.get("player_id")
+                if pid:
+                    p = find_player(room, pid)
+                    if p:
+                        sender_name = p.get("name")
+                if sender_name is None:
+                    sid = data.get("spectator_id")
+                    if sid:
+                        s = find_spectator(room, sid)
+                        if s:
+                            sender_name = s.get("name")
+                if sender_name is None:
+                    sender_name = data.get("name") or "(anonymous)"
+                evt = add(room, "chat_message", {"from": sender_name, "message": msg_text})
+                pub(room, evt)
             elif t == "play_ack":
                 # data: { type: 'play_ack', player_id: '...', index: N }
                 idx = data.get("index")
                 pid = data.get("player_id")
                 if idx is None or pid is None:
-                    await websocket.send_json({"type": "error", "error": "invalid play_ack"})
+                    send(encode_error("invalid play_ack"))
                 else:
-                    async with room["lock"]:
-                        # ensure ack set exists for this index
-                        acks = room.get("play_acks") or {}
-                        s = acks.get(str(idx)) or set()
-                        s.add(pid)
-                        acks[str(idx)] = s
-                        room["play_acks"] = acks
-                        # consider only current players as required ack set
-                        player_ids = {p.get("player_id") for p in room.get("players", [])}
-                        # remove any None
-                        player_ids = {x for x in player_ids if x}
-                        # if no players (e.g., only spectators), allow advance
-                        if not player_ids:
-                            ready = True
-                        else:
-                            ready = player_ids.issubset(s)
+                    # ensure ack set exists for this index
+                    acks = room["play_acks"]
+                    s = acks.get(str(idx)) or set()
+                    s.add(pid)
+                    acks[str(idx)] = s
+                    # consider only current players as required ack set
+                    # (players_by_id のキービューをそのまま集合として使う)
+                    player_ids = room["players_by_id"].keys()
+                    # if no players (e.g., only spectators), allow advance
+                    if not player_ids:
+                        ready = True
+                    else:
+                        ready = player_ids <= s
                     if ready:
                         # broadcast play_continue for this index
-                        try:
-                            await broadcast(room, {"type": "play_continue", "index": idx})
-                        except Exception:
-                            pass
+                        pub(room, {"type": "play_continue", "index": idx})
             elif t == "leave":
                 # グレースフルな退室処理
                 role = data.get("role")
                 token = data.get("id") or data.get("player_id") or data.get("spectator_id")
-                async with room["lock"]:
-                    if role == "player":
-                        before = len(room.get("players", []))
-                        room["players"] = [p for p in room.get("players", []) if p.get("player_id") != token]
-                        after = len(room.get("players", []))
-                        if before != after:
-                            evt = add_event(room, "player_left", {"player_id": token})
-                            await broadcast(room, {"type": evt["type"], "id": evt["id"], "payload": evt["payload"]})
-                    elif role == "spectator":
-                        before = len(room.get("spectators", []))
-                        room["spectators"] = [s for s in room.get("spectators", []) if s.get("spectator_id") != token]
-                        after = len(room.get("spectators", []))
-                        if before != after:
-                            evt = add_event(room, "spectator_left", {"spectator_id": token})
-                            await broadcast(room, {"type": evt["type"], "id": evt["id"], "payload": evt["payload"]})
+                evt = None
+                if role == "player":
+                    left = room["players_by_id"].pop(token, None)
+                    if left is not None:
+                        heapq.heappush(room["free_slots"], left["slot"])
+                        evt = add(room, "player_left", {"player_id": token})
+                        _invalidate_snapshot(room)
+                elif role == "spectator":
+                    left = room["spectators_by_id"].pop(token, None)
+                    if left is not None:
+                        evt = add(room, "spectator_left", {"spectator_id": token})
+                        _invalidate_snapshot(room)
+                if evt is not None:
+                    pub(room, evt)
                 # 接続を閉じる
                 break
             else:
                 # 不明なメッセージタイプは無視ではなくエラーで通知する
-                await websocket.send_json({"type": "error", "error": "unknown message type"})
+                send(encode_error("unknown message type"))
 
             
 
@@ -637,36 +857,42 @@ async def websocket_endpoint(websocket: WebSocket):
     finally:
         # cleanup
         if room is not None:
-            async with room["lock"]:
-                if websocket in room["connections"]:
-                    room["connections"].discard(websocket)
-                # if was player/spectator, remove and broadcast left
-                if client_meta.get("role") == "player":
-                    pid = client_meta.get("player_id")
-                    if pid:
-                        # remove player and clear any ownerships held by this player name
-                        pname = None
-                        for p in room.get("players", []):
-                            if p.get("player_id") == pid:
-                                pname = p.get("name")
-                                break
-                        room["players"] = [p for p in room.get("players", []) if p.get("player_id") != pid]
-                        if pname:
-                            for i, o in enumerate(room.get("owners", [])):
-                                if o == pname:
-                                    room["owners"][i] = ""
-                        evt = add_event(room, "player_left", {"player_id": pid})
-                        pass_evt = evt
-                elif client_meta.get("role") == "spectator":
-                    sid = client_meta.get("spectator_id")
-                    if sid:
-                        room["spectators"] = [s for s in room.get("spectators", []) if s.get("spectator_id") != sid]
-                        evt = add_event(room, "spectator_left", {"spectator_id": sid})
-                        pass_evt = evt
-            # broadcast any left event (do outside the lock to avoid reentrancy)
+            room["connections"].pop(websocket, None)
+            # if was player/spectator, remove and broadcast left
+            if client_meta.get("role") == "player":
+                pid = client_meta.get("player_id")
+                # 明示的な leave で既に削除済みなら何もしない
+                left = room["players_by_id"].pop(pid, None) if pid else None
+                if left is not None:
+                    # remove player and clear any ownerships held by this player name
+                    heapq.heappush(room["free_slots"], left["slot"])
+                    pname = left.get("name")
+                    code = room["owner_codes"].get(pname) if pname else None
+                    if code is not None:
+                        owned = room["owners"].count(code)
+                        if owned:
+                            room["owners"][:] = room["owners"].replace(bytes((code,)), _UNOWNED_BYTE)
+                            room["taken_count"] -= owned
+                    if pname:
+                        room["counts"].pop(pname, None)
+                    evt = add_event(room, "player_left", {"player_id": pid})
+                    pass_evt = evt
+                    _invalidate_snapshot(room)
+            elif client_meta.get("role") == "spectator":
+                sid = client_meta.get("spectator_id")
+                left = room["spectators_by_id"].pop(sid, None) if sid else None
+                if left is not None:
+                    evt = add_event(room, "spectator_left", {"spectator_id": sid})
+                    pass_evt = evt
+                    _invalidate_snapshot(room)
+            # broadcast any left event
+            if pass_evt:
+                publish(room, pass_evt)
+        # 送信キューの残り（join 失敗時のエラーなど）を送ってから接続を閉じる
+        if not writer.done():
+            _enqueue(outq, 1000)
             try:
-                if pass_evt:
-                    await broadcast(room, {"type": pass_evt["type"], "id": pass_evt["id"], "payload": pass_evt["payload"]})
+                await asyncio.wait_for(writer, CLIENT_FLUSH_TIMEOUT)
             except Exception:
                 pass
 
@@ -675,17 +901,22 @@ async def websocket_endpoint(websocket: WebSocket):
 async def get_room(room_id: str):
     r = rooms.get(room_id)
     if not r:
-        return JSONResponse(status_code=404, content={"error": "not found"})
-    return {
-        "room_id": r["room_id"],
-        "players": [{"player_id": p["player_id"], "name": p["name"], "slot": p.get("slot")} for p in r["players"]],
-        "spectators": [{"spectator_id": s["spectator_id"], "name": s["name"]} for s in r["spectators"]],
-        "owners": r.get("owners", []),
-        "card_letters": r.get("card_letters", []),
-        "play_sequence": r.get("play_sequence", []),
-        "next_event_id": r["next_event_id"],
-        "started": r.get("started", False),
-    }
+        return json_response({"error": "not found"}, status_code=404)
+    # 部屋の状態はエンコード済みのまま保持し、変更時（_invalidate_snapshot）に無効化する。
+    # next_event_id はチャットなどスナップショットを作り直さないイベントでも進むため、
+    # 末尾の '}' を外したキャッシュに毎回付け足す。
+    body = r["http_room_bytes"]
+    if body is None:
+        body = r["http_room_bytes"] = orjson.dumps({
+            "room_id": r["room_id"],
+            "players": [{"player_id": p["player_id"], "name": p["name"], "slot": p.get("slot")} for p in r["players_by_id"].values()],
+            "spectators": [{"spectator_id": s["spectator_id"], "name": s["name"]} for s in r["spectators_by_id"].values()],
+            "owners": _owner_list(r),
+            "card_letters": r.get("card_letters", []),
+            "play_sequence": r.get("play_sequence", []),
+            "started": r.get("started", False),
+        })[:-1]
+    return Response(content=body + b',"next_event_id":%d}' % r["next_event_id"], media_type="application/json")
 
 
 @app.get("/rooms/{room_id}/events")
@@ -693,7 +924,7 @@ async def get_events(room_id: str, since_id: int = Query(0, alias="since_id"), l
     """Return events for a room with id > since_id. Limit capped to 1000."""
     r = rooms.get(room_id)
     if not r:
-        return JSONResponse(status_code=404, content={"error": "not found"})
+        return json_response({"error": "not found"}, status_code=404)
     try:
         since = int(since_id or 0)
     except Exception:
@@ -702,27 +933,29 @@ async def get_events(room_id: str, since_id: int = Query(0, alias="since_id"), l
         limit = max(0, min(int(limit or 100), 1000))
     except Exception:
         limit = 100
-    evs = [e for e in r.get("events", []) if int(e.get("id", 0)) > since]
-    if limit:
-        evs = evs[:limit]
-    return {"events": evs, "next_event_id": r["next_event_id"]}
+    events = r["events"]
+    # イベント ID は連番で、deque は古いものから順に捨てるため、
+    # 先頭 ID との差から開始位置を求めて必要な範囲だけ取り出す
+    start = max(0, since + 1 - events[0]["id"]) if events else 0
+    evs = list(itertools.islice(events, start, start + limit if limit else None))
+    return json_response({"events": evs, "next_event_id": r["next_event_id"]})
 
 
 @app.get("/")
 async def root():
     # Simple root for health checks / informational purpose
-    return {"status": "ok", "message": "Hyakunin WebSocket server"}
+    return json_response({"status": "ok", "message": "Hyakunin WebSocket server"})
 
 
 @app.get("/health")
 async def health():
-    return JSONResponse(status_code=200, content={"status": "ok"})
+    return json_response({"status": "ok"})
 
 
 @app.get("/favicon.ico")
 async def favicon():
     # Return no content to avoid 404 noise from browsers/health checks
-    return JSONResponse(status_code=204, content=None)
+    return Response(status_code=204)
 
 
 if __name__ == "__main__":
@@ -731,6 +964,16 @@ if __name__ == "__main__":
     # for local development.
     import uvicorn
     import os
+    import sys
 
     port = int(os.environ.get("PORT", "5001"))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    # uvloop / httptools で I/O とイベントループを高速化する。
+    # uvloop は Windows 非対応なので、その場合は標準の asyncio ループを使う。
+    loop = "asyncio" if sys.platform == "win32" else "uvloop"
+    # メッセージの大半は小さなイベントで、圧縮の CPU コストに見合わないため
+    # permessage-deflate は無効にする（接続ごとの zlib コンテキストも不要になる）
+    uvicorn.run(
+        app, host="0.0.0.0", port=port, loop=loop, http="httptools", ws="websockets-sansio",
+        ws_ping_interval=WS_PING_INTERVAL, ws_ping_timeout=WS_PING_TIMEOUT,
+        ws_per_message_deflate=False,
+    )